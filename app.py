@@ -1,9 +1,22 @@
 import os
+from functools import wraps
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (
+    Flask, render_template, request, flash, redirect, session, g, abort
+)
+from flask_caching import Cache
 from flask_debugtoolbar import DebugToolbarExtension
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from jinja2 import FileSystemBytecodeCache
+from psycopg2.errors import UniqueViolation
+from sqlalchemy import or_
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
+from werkzeug.local import LocalProxy
+from werkzeug.middleware.proxy_fix import ProxyFix
 
+from config import configs
 from forms import (
     UserAddForm,
     LoginForm,
@@ -11,20 +24,32 @@ from forms import (
     EditProfileForm,
     CSRFValidationForm
 )
-from models import db, connect_db, User, Message, Like
-
-# Get DB_URI from environmental variable (useful for production/testing) or,
-# if not set there, use local db.
-DATABASE_URL = os.environ.get('DATABASE_URL', 'postgresql:///warbler')
+from models import (
+    db, connect_db, bcrypt, DEFAULT_IMAGE_URL, User, Message, Like, Follows
+)
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+app.config.from_object(configs[os.environ.get('WARBLER_CONFIG', 'default')])
+
+# take the client address from X-Forwarded-For when behind proxies, so rate
+# limits apply per client rather than to the proxy (see config.py)
+if app.config['PROXY_FIX_X_FOR']:
+    app.wsgi_app = ProxyFix(
+        app.wsgi_app,
+        x_for=app.config['PROXY_FIX_X_FOR'],
+        x_proto=app.config['PROXY_FIX_X_FOR'],
+    )
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
 toolbar = DebugToolbarExtension(app)
+cache = Cache(app)
+limiter = Limiter(get_remote_address, app=app)
+
+# Keep compiled templates on disk so new processes skip recompiling them.
+if app.config.get('JINJA_BYTECODE_CACHE_DIR'):
+    os.makedirs(app.config['JINJA_BYTECODE_CACHE_DIR'], exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+        app.config['JINJA_BYTECODE_CACHE_DIR']
+    )
 
 connect_db(app)
 
@@ -35,15 +60,28 @@ CURR_USER_KEY = "curr_user"
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    # TODO look into flask middleware for this
+    The user is wrapped in a proxy so it is only fetched from the DB the
+    first time a route or template actually uses `g.user`.
+    """
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    g.pop("_curr_user", None)
+    g.user = LocalProxy(_load_curr_user)
 
-    else:
-        g.user = None
+
+def _load_curr_user():
+    """Return the logged-in user (or None), querying at most once per request."""
+
+    if "_curr_user" not in g:
+        user_id = session.get(CURR_USER_KEY)
+        g._curr_user = db.session.get(User, user_id) if user_id else None
+
+        # the user was deleted since logging in: treat them as logged out
+        if user_id and g._curr_user is None:
+            do_logout()
+
+    return g._curr_user
 
 
 def do_login(user):
@@ -59,6 +97,24 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+def login_required(view):
+    """Send anon users back to the homepage instead of running `view`.
+
+    Anon requests never load a user or build the view's forms; a session
+    whose user no longer exists gets the same treatment.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if CURR_USER_KEY not in session or not g.user:
+            flash("Access unauthorized.", "danger")
+            return redirect("/")
+
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
@@ -74,12 +130,25 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        # check the unique indexes before spending a bcrypt hash on a signup
+        # that can't succeed; the IntegrityError catch below still covers
+        # two signups racing for the same username
+        taken = db.session.scalar(
+            db.select(User.id).where(or_(
+                User.username == form.username.data,
+                User.email == form.email.data,
+            ))
+        )
+        if taken:
+            flash("Username already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
                 password=form.password.data,
                 email=form.email.data,
-                image_url=form.image_url.data or User.image_url.default.arg,
+                image_url=form.image_url.data or DEFAULT_IMAGE_URL,
             )
             db.session.commit()
 
@@ -97,6 +166,8 @@ def signup():
 
 
 @app.route('/login', methods=["GET", "POST"])
+# every login attempt costs a bcrypt check, so don't let anyone spam them
+@limiter.limit("5/minute", methods=["POST"])
 def login():
     """Handle user login."""
 
@@ -135,80 +206,96 @@ def logout():
 # General user routes:
 
 @app.route('/users')
+@login_required
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and a
+    'page' param to pick which page of 50 users to show.
     """
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     search = request.args.get('q')
     form = CSRFValidationForm()
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    query = db.select(User).order_by(User.username)
+    if search:
+        query = query.where(User.username.ilike(f"%{search}%"))
+
+    # page number is read from the querystring by paginate
+    users = db.paginate(query, per_page=50)
 
     return render_template('users/index.html', users=users, form=form)
 
 
 @app.route('/users/<int:user_id>')
+@login_required
 def users_show(user_id):
     """Show user profile."""
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     form = CSRFValidationForm()
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
 
     return render_template('users/show.html', user=user, form=form)
 
 
 @app.route('/users/<int:user_id>/following')
+@login_required
 def show_following(user_id):
     """Show list of people this user is following."""
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     form = CSRFValidationForm()
-    user = User.query.get_or_404(user_id)
+    user = db.session.get(User, user_id, options=[selectinload(User.following)])
+    if user is None:
+        abort(404)
+
     return render_template('users/following.html', user=user, form=form)
 
 
 @app.route('/users/<int:user_id>/followers')
+@login_required
 def users_followers(user_id):
     """Show list of followers of this user."""
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     form = CSRFValidationForm()
-    user = User.query.get_or_404(user_id)
+    user = db.session.get(User, user_id, options=[selectinload(User.followers)])
+    if user is None:
+        abort(404)
+
     return render_template('users/followers.html', user=user, form=form)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=["GET", "POST"])
+@login_required
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     form = CSRFValidationForm()
     if form.validate_on_submit():
-        followed_user = User.query.get_or_404(follow_id)
-        g.user.following.append(followed_user)
-        db.session.commit()
+        # write the follows row directly rather than through
+        # g.user.following, which would load everyone they already follow
+        user_id = g.user.id
+        try:
+            result = db.session.execute(
+                db.insert(Follows).from_select(
+                    ["user_following_id", "user_being_followed_id"],
+                    db.select(db.literal(user_id), User.id).where(
+                        User.id == follow_id
+                    ),
+                )
+            )
+            db.session.commit()
+        except IntegrityError as error:
+            db.session.rollback()
+            # a duplicate primary key just means they already follow them;
+            # any other violation (e.g. a foreign key) is a real error
+            if not isinstance(error.orig, UniqueViolation):
+                raise
+            return redirect(request.referrer)
+
+        if result.rowcount == 0:
+            abort(404)
+
+        cache.delete_memoized(timeline_message_ids, user_id)
         # return redirect(f"/users/{g.user.id}/following")
         return redirect(request.referrer)
     else:
@@ -217,18 +304,21 @@ def add_follow(follow_id):
 
 
 @app.route('/users/stop-following/<int:follow_id>', methods=["GET", "POST"])
+@login_required
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     form = CSRFValidationForm()
     if form.validate_on_submit():
-        followed_user = User.query.get(follow_id)
-        g.user.following.remove(followed_user)
+        user_id = g.user.id
+        db.session.execute(
+            db.delete(Follows).where(
+                Follows.user_following_id == user_id,
+                Follows.user_being_followed_id == follow_id,
+            )
+        )
         db.session.commit()
+        cache.delete_memoized(timeline_message_ids, user_id)
         # return redirect(f"/users/{g.user.id}/following")
         return redirect(request.referrer)
     else:
@@ -237,27 +327,24 @@ def stop_following(follow_id):
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
+@login_required
 def profile():
     """Update profile for current user."""
 
-    # check for failure first
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect('/')
-
     form = EditProfileForm(obj=g.user)
 
     # post request route
     if form.validate_on_submit():
         password = form.password.data
-        auth_user = User.authenticate(g.user.username, password)
+        # g.user is already loaded, so check the password against it directly
+        # instead of looking the user up again with User.authenticate
         # if user is authenticated, then check edit profile form inputs
-        if auth_user:
-            auth_user.username = form.username.data
-            auth_user.email = form.email.data
-            auth_user.image_url = form.image_url.data
-            auth_user.header_image_url = form.header_image_url.data
-            auth_user.bio = form.bio.data
+        if bcrypt.check_password_hash(g.user.password, password):
+            g.user.username = form.username.data
+            g.user.email = form.email.data
+            g.user.image_url = form.image_url.data
+            g.user.header_image_url = form.header_image_url.data
+            g.user.bio = form.bio.data
             db.session.commit()
             return redirect(f"/users/{g.user.id}")
         else:
@@ -269,19 +356,17 @@ def profile():
 
 
 @app.route('/users/delete', methods=["GET", "POST"])
+@login_required
 def delete_user():
     """Delete user."""
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     form = CSRFValidationForm()
 
     if form.validate_on_submit():
         do_logout()
         flash("Successfully deleted!")
-        db.session.delete(g.user)
+        # SQLAlchemy needs the real User instance, not the proxy around it
+        db.session.delete(g.user._get_current_object())
         db.session.commit()
         return redirect("/signup")
     else:
@@ -293,64 +378,57 @@ def delete_user():
 # Messages routes:
 
 @app.route('/messages/new', methods=["GET", "POST"])
+@login_required
 def messages_add():
     """Add a message:
 
     Show form if GET. If valid, update message and redirect to user page.
     """
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     form = MessageForm()
 
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
         db.session.commit()
+        clear_timelines(g.user.id)
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@login_required
 def messages_show(message_id):
     """Show a message."""
 
-    # checking that the current user is logged in may not
+    # requiring the current user to be logged in may not
     # be super crucial in this route but it can't hurt.
     # TODO may want to change this in some way once the concept of
     # public/private profiles gets introduced
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     form = CSRFValidationForm()
-    msg = Message.query.get(message_id)
+    # the page shows the author, so load them alongside the message
+    msg = db.session.get(Message, message_id, options=[joinedload(Message.user)])
+    if msg is None:
+        abort(404)
+
     return render_template('messages/show.html', message=msg, form=form)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["GET", "POST"])
+@login_required
 def messages_destroy(message_id):
     """Delete a message."""
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     form = CSRFValidationForm()
 
     if form.validate_on_submit():
-        # before deleting msg from messages table, need to remove from likes
-        if Like.query.filter(Like.message_id == message_id).all():
-            Like.query.filter(Like.message_id == message_id).all().delete()
-            db.session.commit()
-
-        msg = Message.query.get(message_id)
+        # likes of this msg are removed by the db via ON DELETE CASCADE
+        msg = db.get_or_404(Message, message_id)
         db.session.delete(msg)
         db.session.commit()
+        clear_timelines(msg.user_id)
         return redirect(f"/users/{g.user.id}")
     else:
         flash("Access unauthorized.", "danger")
@@ -358,17 +436,15 @@ def messages_destroy(message_id):
 
 
 @app.route('/messages/<int:message_id>/like', methods=["GET", "POST"])
+@login_required
 def like_message(message_id):
     """Adds a message to logged in user's likes"""
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     form = CSRFValidationForm()
 
     if form.validate_on_submit():
-        msg = Message.query.get_or_404(message_id)
+        user_id = g.user.id
+
         # TODO refactor referrer line below to find a more reliable method of
         # grabbing the origin of the request given that this setting
         # may be disabled for some users
@@ -377,16 +453,35 @@ def like_message(message_id):
         # TODO additional note here to incorporate like functionality
         # as a method in a class instead
 
-        # only allow users to like OTHER users' posts
-        # check for failure first
-        if msg.user_id == g.user.id:
-            flash("You can't like your own posts!", "danger")
-            return redirect(origin_of_req)
-        else:
-            # append msg to that user's liked messages
-            g.user.liked_messages.append(msg)
+        # only allow users to like OTHER users' posts: the like is inserted
+        # straight from the messages table, so nothing is inserted if the
+        # msg doesn't exist or belongs to this user
+        try:
+            result = db.session.execute(
+                db.insert(Like).from_select(
+                    ["user_id", "message_id"],
+                    db.select(db.literal(user_id), Message.id).where(
+                        Message.id == message_id,
+                        Message.user_id != user_id,
+                    ),
+                )
+            )
             db.session.commit()
+        except IntegrityError as error:
+            db.session.rollback()
+            # a duplicate primary key just means it's already liked; any
+            # other violation (e.g. a foreign key) is a real error
+            if not isinstance(error.orig, UniqueViolation):
+                raise
             return redirect(origin_of_req)
+
+        if result.rowcount == 0:
+            # nothing inserted: 404 if the msg doesn't exist, otherwise
+            # it's the user's own (the result itself isn't needed)
+            db.get_or_404(Message, message_id)
+            flash("You can't like your own posts!", "danger")
+
+        return redirect(origin_of_req)
     else:
         flash("Access unauthorized.", "danger")
         return redirect("/")
@@ -394,18 +489,14 @@ def like_message(message_id):
 
 # think about different HTTP verbs in other contexts
 @app.route('/messages/<int:message_id>/unlike', methods=["GET", "POST"])
+@login_required
 def unlike_message(message_id):
     """Removes a message from logged in user's likes"""
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
     form = CSRFValidationForm()
 
     if form.validate_on_submit():
-        # grab the liked message we want to unlike
-        msg = Message.query.get_or_404(message_id)
+        user_id = g.user.id
 
         # TODO refactor referrer line below to find a more reliable method of
         # grabbing the origin of the request given that this setting
@@ -415,7 +506,12 @@ def unlike_message(message_id):
         # remove from user's list of liked messages
         # TODO additional note here to incorporate unlike functionality
         # as a method in a class instead
-        g.user.liked_messages.remove(msg)
+        db.session.execute(
+            db.delete(Like).where(
+                Like.user_id == user_id,
+                Like.message_id == message_id,
+            )
+        )
         db.session.commit()
         return redirect(origin_of_req)
     else:
@@ -424,14 +520,19 @@ def unlike_message(message_id):
 
 
 @app.route('/users/<int:user_id>/likes')
+@login_required
 def show_likes(user_id):
     """Shows liked messages for a particular user"""
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
+    # each liked message is shown with its author, so batch-load both
+    user = db.session.get(
+        User,
+        user_id,
+        options=[selectinload(User.liked_messages).joinedload(Message.user)],
+    )
+    if user is None:
+        abort(404)
 
-    user = User.query.get_or_404(user_id)
     form = CSRFValidationForm()
 
     # TODO arrange liked messages in desc order by when like occurred
@@ -441,6 +542,62 @@ def show_likes(user_id):
 ##############################################################################
 # Homepage and error pages
 
+def timelines_cached():
+    """Are timelines cached? Not without a shared (redis) cache."""
+
+    return app.config['CACHE_TYPE'] != 'NullCache'
+
+
+def timeline_select(user_id):
+    """Select the 100 most recent messages from users that `user_id`
+    follows (& the user themselves), newest first."""
+
+    # ids of the users that current user is following, as a subquery so
+    # postgres resolves them in the same statement as the messages
+    followed_ids = (
+        db.select(Follows.user_being_followed_id)
+        .where(Follows.user_following_id == user_id)
+    )
+    # only pull in messages from followed users (& the user)
+    return (
+        db.select(Message)
+        .where(or_(
+            Message.user_id.in_(followed_ids),
+            Message.user_id == user_id,
+        ))
+        .order_by(Message.timestamp.desc())
+        .limit(100)
+    )
+
+
+@cache.memoize(timeout=30)
+def timeline_message_ids(user_id):
+    """Ids of the messages on `user_id`'s timeline, newest first.
+
+    Only ids are cached since ORM objects don't survive being pickled
+    into a shared cache.
+    """
+
+    return db.session.scalars(
+        timeline_select(user_id).with_only_columns(Message.id)
+    ).all()
+
+
+def clear_timelines(user_id):
+    """Drop cached timelines that show messages from `user_id`."""
+
+    if not timelines_cached():
+        return
+
+    follower_ids = db.session.scalars(
+        db.select(Follows.user_following_id)
+        .where(Follows.user_being_followed_id == user_id)
+    )
+
+    for timeline_owner_id in [user_id, *follower_ids]:
+        cache.delete_memoized(timeline_message_ids, timeline_owner_id)
+
+
 @app.route('/')
 def homepage():
     """Show homepage:
@@ -449,17 +606,19 @@ def homepage():
     - logged in: 100 most recent messages of followed_users
     """
     if g.user:
-        # grab the ids of the users that current user is following (& the user)
-        users_to_display = [user.id for user in g.user.following] + [g.user.id]
-        # only pull in messages from users whose ids are in the above list
-        messages = (
-            Message
-            .query
-            .filter(Message.user_id.in_(users_to_display))
-            .order_by(Message.timestamp.desc())
-            .limit(100)
-            .all()
-        )
+        if timelines_cached():
+            message_ids = timeline_message_ids(g.user.id)
+            messages = (
+                Message
+                .query
+                .filter(Message.id.in_(message_ids))
+                .order_by(Message.timestamp.desc())
+                .all()
+            )
+        else:
+            # no cache to fill, so get the messages in one statement
+            messages = db.session.scalars(timeline_select(g.user.id)).all()
+
         form = CSRFValidationForm()
 
         return render_template('home.html', messages=messages, form=form)
@@ -0,0 +1,81 @@
+"""Configuration for the warbler app.
+
+app.py loads the class named by the WARBLER_CONFIG environment variable
+(see `configs` below), defaulting to the regular Config.
+"""
+
+import os
+
+from sqlalchemy.pool import NullPool
+
+# Cached timelines are shared between workers through redis. A per-process
+# cache would let workers that didn't handle a write keep serving stale
+# timelines, so without redis there's no caching at all.
+REDIS_URL = os.environ.get('REDIS_URL')
+
+
+class Config:
+    """Settings for running the app."""
+
+    # Get DB_URI from environmental variable (useful for production) or,
+    # if not set there, use local db.
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'DATABASE_URL', 'postgresql:///warbler'
+    )
+    # Keep warm connections around for reuse across requests. Sized so that
+    # the default 4 gunicorn workers stay under postgres' default
+    # max_connections.
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': 10,
+        'max_overflow': 10,
+        'pool_pre_ping': True,
+        'pool_recycle': 3600,
+    }
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+    SECRET_KEY = os.environ.get('SECRET_KEY', "it's a secret")
+    BCRYPT_LOG_ROUNDS = 12
+
+    CACHE_TYPE = 'RedisCache' if REDIS_URL else 'NullCache'
+    CACHE_REDIS_URL = REDIS_URL
+    # Without redis each worker counts requests on its own, so a limit like
+    # the login view's "5/minute" really allows that many per worker (up to
+    # 20 with gunicorn's default 4). Still better than no limit at all, so
+    # set REDIS_URL in production to make the limits exact.
+    RATELIMIT_STORAGE_URI = REDIS_URL or 'memory://'
+    # Rate limits are per client address. Behind a reverse proxy every
+    # request comes from the proxy, so set this to the number of proxies in
+    # front of the app to take the client address from X-Forwarded-For.
+    # Leave it at 0 when clients connect directly, or they could spoof it.
+    PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR', 0))
+
+
+class TestingConfig(Config):
+    """Settings for the test suite: a separate db, and no CSRF, slow
+    password hashing or caching getting in the way."""
+
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'TEST_DATABASE_URL', 'postgresql:///warbler_test'
+    )
+    # The tests share one connection that conftest.py holds open for the
+    # whole run, so there's nothing for a pool to do.
+    SQLALCHEMY_ENGINE_OPTIONS = {'poolclass': NullPool}
+
+    WTF_CSRF_ENABLED = False
+    BCRYPT_LOG_ROUNDS = 4
+    # counted in-process; conftest.py resets the counts before every test
+    RATELIMIT_STORAGE_URI = 'memory://'
+    CACHE_TYPE = 'NullCache'
+    # Every test run starts a fresh process, so reuse compiled templates.
+    JINJA_BYTECODE_CACHE_DIR = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '.jinja_cache'
+    )
+
+
+configs = {
+    'default': Config,
+    'testing': TestingConfig,
+}
@@ -0,0 +1,163 @@
+"""Shared pytest setup for the warbler test modules.
+
+The tests need postgres. The test database is thrown away after every
+run, so a dedicated test cluster (e.g. in CI) can drop the crash-safety
+settings, with its data directory on a tmpfs:
+
+    pg_ctl -D "$PGDATA" start \\
+        -o "-c fsync=off -c synchronous_commit=off -c full_page_writes=off"
+
+Against a regular server, each test connection still turns off
+synchronous_commit for itself (see skip_commit_fsync below).
+"""
+
+import os
+
+import pytest
+from sqlalchemy import create_engine, event, make_url, text
+from sqlalchemy.orm import raiseload, scoped_session, sessionmaker
+
+# BEFORE we import our app, switch it to the testing config (the app connects
+# as soon as it's imported, so this has to happen first)
+
+os.environ['WARBLER_CONFIG'] = "testing"
+
+# Under pytest-xdist (pytest -n auto) every worker gets a database of its own,
+# so workers truncating tables don't wipe out each other's sample data.
+
+XDIST_WORKER = os.environ.get('PYTEST_XDIST_WORKER')
+
+if XDIST_WORKER:
+    test_db_url = make_url(os.environ.get(
+        'TEST_DATABASE_URL', "postgresql:///warbler_test"
+    ))
+    os.environ['TEST_DATABASE_URL'] = test_db_url.set(
+        database=f"{test_db_url.database}_{XDIST_WORKER}"
+    ).render_as_string(hide_password=False)
+
+from models import db  # noqa: E402
+from app import app as warbler_app, limiter  # noqa: E402
+
+
+# The tests rely on postgres (TRUNCATE, the count triggers), so rather than
+# swapping in sqlite, skip waiting for the WAL flush on every test commit.
+# Nothing here needs to survive a crash.
+
+@event.listens_for(db.engine, "connect")
+def skip_commit_fsync(dbapi_connection, connection_record):
+    """Turn off synchronous_commit for each new test db connection."""
+
+    with dbapi_connection.cursor() as cursor:
+        cursor.execute("SET synchronous_commit TO off")
+    dbapi_connection.commit()
+
+
+def create_database(url):
+    """Create the postgres database at `url` if it doesn't exist yet."""
+
+    url = make_url(url)
+    engine = create_engine(
+        url.set(database="postgres"), isolation_level="AUTOCOMMIT"
+    )
+
+    with engine.connect() as connection:
+        exists = connection.scalar(
+            text("SELECT 1 FROM pg_database WHERE datname = :name"),
+            {"name": url.database},
+        )
+        if not exists:
+            connection.execute(text(f'CREATE DATABASE "{url.database}"'))
+
+    engine.dispose()
+
+
+def clear_tables():
+    """Delete all rows, so a test starts from an empty db."""
+
+    # one TRUNCATE clears every table, rather than a DELETE per model
+    db.session.execute(text(
+        "TRUNCATE TABLE likes, follows, messages, users "
+        "RESTART IDENTITY CASCADE"
+    ))
+    db.session.commit()
+
+    # RESTART IDENTITY reuses ids, so forget objects from the old rows
+    db.session.expunge_all()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def create_tables():
+    """Create our tables once for the whole test run (per xdist worker)."""
+
+    if XDIST_WORKER:
+        create_database(db.engine.url)
+
+    db.create_all()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def db_connection(create_tables):
+    """Run every test's db work over one connection held for the whole run.
+
+    db.session is swapped for a session bound to that connection. The app
+    context stays pushed during the tests, so the session isn't removed
+    between test client requests either.
+    """
+
+    connection = db.engine.connect()
+    app_session = db.session
+    db.session = scoped_session(sessionmaker(bind=connection))
+
+    yield connection
+
+    db.session.remove()
+    db.session = app_session
+    connection.close()
+
+
+def raise_on_lazy_loads(execute_state):
+    """Make relationships of queried objects raise rather than lazy load."""
+
+    if (
+        execute_state.is_select
+        and not execute_state.is_column_load
+        and not execute_state.is_relationship_load
+    ):
+        execute_state.statement = execute_state.statement.options(
+            raiseload('*', sql_only=True)
+        )
+
+
+@pytest.fixture
+def no_lazy_loads():
+    """Fail a test on any accidental N+1.
+
+    Test classes opt in with @pytest.mark.usefixtures("no_lazy_loads");
+    their tests have to load relationships explicitly (e.g. selectinload).
+    """
+
+    event.listen(db.session, "do_orm_execute", raise_on_lazy_loads)
+    yield
+    event.remove(db.session, "do_orm_execute", raise_on_lazy_loads)
+
+
+@pytest.fixture(autouse=True)
+def reset_rate_limits():
+    """Give every test a fresh allowance of rate-limited requests."""
+
+    limiter.reset()
+
+
+@pytest.fixture(scope="session")
+def app():
+    """The Flask app, built once for the whole run with the testing config."""
+
+    return warbler_app
+
+
+@pytest.fixture(scope="class", autouse=True)
+def attach_app(request, app):
+    """Hand the app to unittest-style test classes as `cls.app`."""
+
+    if request.cls is not None:
+        request.cls.app = app
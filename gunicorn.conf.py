@@ -0,0 +1,10 @@
+"""gunicorn settings for Warbler (see wsgi.py)."""
+
+import os
+
+wsgi_app = "wsgi:app"
+
+# every view waits on postgres, so let each worker juggle many requests
+worker_class = "gevent"
+workers = int(os.environ.get("WEB_CONCURRENCY", 4))
+worker_connections = 1000
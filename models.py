@@ -4,10 +4,13 @@ from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, text
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+DEFAULT_IMAGE_URL = "/static/images/default-pic.png"
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -76,7 +79,7 @@ class User(db.Model):
 
     image_url = db.Column(
         db.Text,
-        default="/static/images/default-pic.png",
+        default=DEFAULT_IMAGE_URL,
     )
 
     header_image_url = db.Column(
@@ -97,6 +100,26 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts so profile stats don't load whole collections.
+    # These are kept up to date by triggers in the db (see bottom of file).
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        server_default="0",
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        server_default="0",
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        server_default="0",
+    )
+
     messages = db.relationship('Message', order_by='Message.timestamp.desc()')
 
     followers = db.relationship(
@@ -116,7 +139,8 @@ class User(db.Model):
     liked_messages = db.relationship(
         'Message',  # what table do i want to fetch things FROM
         secondary='likes', # through likes table
-        backref="liked_by_users"
+        # let the likes FK cascade clean up rows when a message is deleted
+        backref=db.backref("liked_by_users", passive_deletes=True)
     )
 
     def __repr__(self):
@@ -177,6 +201,35 @@ class User(db.Model):
     # will need to refactor like/unlike routes to utilize new method(s)
     # and write additional tests to verify functionality
 
+
+# Searching users runs `username ILIKE '%term%'`, which a btree index can't
+# serve but a trigram GIN index can. pg_trgm ships in postgres' contrib
+# package, so only build the index where the extension is available, and
+# warn when it isn't since searches then scan the whole users table.
+USERNAME_TRGM_INDEX = DDL("""
+    DO $$
+    BEGIN
+        IF EXISTS (
+            SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'
+        ) THEN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            CREATE INDEX IF NOT EXISTS ix_users_username_trgm
+                ON users USING gin (username gin_trgm_ops);
+        ELSE
+            RAISE WARNING 'pg_trgm is not available, so '
+                'ix_users_username_trgm was not created and user searches '
+                'will scan the whole users table';
+        END IF;
+    END $$;
+""")
+
+event.listen(
+    User.__table__,
+    "after_create",
+    USERNAME_TRGM_INDEX.execute_if(dialect="postgresql"),
+)
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
@@ -204,12 +257,122 @@ class Message(db.Model):
         nullable=False,
     )
 
-    user = db.relationship('User')
+    # timelines and profiles read a user's newest messages first
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', user_id, timestamp.desc()),
+    )
+
+    # messages are nearly always listed with their author, so fetch the
+    # authors of a batch of messages in one extra query rather than one each
+    user = db.relationship('User', lazy='selectin')
 
     def __repr__(self):
         return f"<Message #{self.id}, Author ID:{self.user_id}>"
 
 
+# Keep the users.*_count columns in step with the follows and messages
+# tables. Triggers (rather than ORM events) also catch bulk inserts, raw
+# SQL and rows removed by ON DELETE CASCADE when a user is deleted.
+FOLLOW_COUNTS_TRIGGER = DDL("""
+    CREATE OR REPLACE FUNCTION update_follow_counts() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE users SET followers_count = followers_count + 1
+                WHERE id = NEW.user_being_followed_id;
+            UPDATE users SET following_count = following_count + 1
+                WHERE id = NEW.user_following_id;
+            RETURN NEW;
+        END IF;
+
+        UPDATE users SET followers_count = followers_count - 1
+            WHERE id = OLD.user_being_followed_id;
+        UPDATE users SET following_count = following_count - 1
+            WHERE id = OLD.user_following_id;
+        RETURN OLD;
+    END $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS follows_update_counts ON follows;
+    CREATE TRIGGER follows_update_counts
+        AFTER INSERT OR DELETE ON follows
+        FOR EACH ROW EXECUTE FUNCTION update_follow_counts();
+""")
+
+MESSAGES_COUNT_TRIGGER = DDL("""
+    CREATE OR REPLACE FUNCTION update_messages_count() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE users SET messages_count = messages_count + 1
+                WHERE id = NEW.user_id;
+            RETURN NEW;
+        END IF;
+
+        UPDATE users SET messages_count = messages_count - 1
+            WHERE id = OLD.user_id;
+        RETURN OLD;
+    END $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS messages_update_count ON messages;
+    CREATE TRIGGER messages_update_count
+        AFTER INSERT OR DELETE ON messages
+        FOR EACH ROW EXECUTE FUNCTION update_messages_count();
+""")
+
+event.listen(
+    Follows.__table__,
+    "after_create",
+    FOLLOW_COUNTS_TRIGGER.execute_if(dialect="postgresql"),
+)
+
+event.listen(
+    Message.__table__,
+    "after_create",
+    MESSAGES_COUNT_TRIGGER.execute_if(dialect="postgresql"),
+)
+
+
+def upgrade_db():
+    """Bring a db created by an older version of these models up to date.
+
+    db.create_all() skips tables that already exist, so on an existing db
+    this adds the users.*_count columns, the indexes and the count triggers,
+    then fills the counts in from the messages and follows tables. Safe to
+    run more than once.
+    """
+
+    for column in ("messages_count", "followers_count", "following_count"):
+        db.session.execute(text(
+            f"ALTER TABLE users ADD COLUMN IF NOT EXISTS {column} "
+            "integer NOT NULL DEFAULT 0"
+        ))
+
+    connection = db.session.connection()
+    for index in Message.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+    for ddl in (
+        USERNAME_TRGM_INDEX, FOLLOW_COUNTS_TRIGGER, MESSAGES_COUNT_TRIGGER
+    ):
+        db.session.execute(ddl)
+
+    db.session.execute(text("""
+        UPDATE users SET
+            messages_count = (
+                SELECT count(*) FROM messages
+                WHERE messages.user_id = users.id
+            ),
+            followers_count = (
+                SELECT count(*) FROM follows
+                WHERE follows.user_being_followed_id = users.id
+            ),
+            following_count = (
+                SELECT count(*) FROM follows
+                WHERE follows.user_following_id = users.id
+            )
+    """))
+
+    db.session.commit()
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -218,4 +381,5 @@ def connect_db(app):
 
     app.app_context().push()
     db.app = app
-    db.init_app(app)
\ No newline at end of file
+    db.init_app(app)
+    bcrypt.init_app(app)
@@ -2,42 +2,28 @@
 
 # run these tests like:
 #
-#    python -m unittest test_message_model.py
+#    python -m pytest test_message_model.py
 
 
-import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows, Like
+import pytest
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+from conftest import clear_tables
+from models import db, User, Message, Like
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-# Now we can import app
-
-from app import app
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
+# Tables are created once for the whole run in conftest.py --- in each
+# test, we'll delete the data and create fresh new clean test data
 
 
+@pytest.mark.usefixtures("no_lazy_loads")
 class MessageModelTestCase(TestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        Follows.query.delete()
-        Like.query.delete()
-        Message.query.delete()
-        User.query.delete()
+        clear_tables()
 
         u = User(
             email="test@test.com",
@@ -48,9 +34,14 @@ class MessageModelTestCase(TestCase):
         db.session.add(u)
         db.session.commit()
 
-        self.client = app.test_client()
+        self.client = self.app.test_client()
         self.user = u
 
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+
     def test_message_model(self):
         """Does basic model work?"""
 
@@ -79,6 +70,24 @@ class MessageModelTestCase(TestCase):
         self.assertEqual(len(u2.messages), 0)
         self.assertEqual(len(u2.followers), 0)
 
+    def test_messages_count(self):
+        """Is the user's message count kept in step with their messages?"""
+
+        msg = Message(
+            text="test message 123",
+            user_id=self.user.id
+        )
+
+        db.session.add(msg)
+        db.session.commit()
+
+        self.assertEqual(self.user.messages_count, 1)
+
+        db.session.delete(msg)
+        db.session.commit()
+
+        self.assertEqual(self.user.messages_count, 0)
+
     def test_msg_repr(self):
         """Does the message repr method return what we expect?"""
 
@@ -2,34 +2,17 @@
 
 # run these tests like:
 #
-#    FLASK_ENV=production python -m unittest test_message_views.py
+#    FLASK_ENV=production python -m pytest test_message_views.py
 
 
-import os
 from unittest import TestCase
 
-from models import db, Message, User
+from app import CURR_USER_KEY, cache
+from conftest import clear_tables
+from models import db, Message, User, Like, Follows
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-# Now we can import app
-
-from app import app, CURR_USER_KEY
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
-
-# Don't have WTForms use CSRF at all, since it's a pain to test
-
-app.config['WTF_CSRF_ENABLED'] = False
+# Tables are created once for the whole run in conftest.py --- in each
+# test, we'll delete the data and create fresh new clean test data
 
 
 class MessageViewTestCase(TestCase):
@@ -41,7 +24,7 @@ class MessageViewTestCase(TestCase):
         User.query.delete()
         Message.query.delete()
 
-        self.client = app.test_client()
+        self.client = self.app.test_client()
 
         self.testuser = User.signup(
             username="testuser",
@@ -72,3 +55,195 @@ class MessageViewTestCase(TestCase):
 
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
+
+    def test_like_message(self):
+        """Can a user like another user's message?"""
+
+        other_user = User.signup(
+            username="otheruser",
+            email="other@test.com",
+            password="otheruser",
+            image_url=None
+        )
+        db.session.flush()
+
+        msg = Message(text="Like me", user_id=other_user.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post(
+                f"/messages/{msg.id}/like",
+                headers={"Referer": "/"}
+            )
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Like.query.count(), 1)
+
+            # liking it again leaves the existing like alone
+            resp = c.post(
+                f"/messages/{msg.id}/like",
+                headers={"Referer": "/"}
+            )
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Like.query.count(), 1)
+
+    def test_cannot_like_own_message(self):
+        """Is a user unable to like their own messages?"""
+
+        msg = Message(text="Hello", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post(
+                f"/messages/{msg.id}/like",
+                headers={"Referer": "/"},
+                follow_redirects=True
+            )
+            html = resp.data
+
+            self.assertIn(b"You can&#39;t like your own posts!", html)
+            self.assertEqual(Like.query.count(), 0)
+
+
+    def test_delete_liked_message(self):
+        """Does deleting a liked message remove it and its likes?"""
+
+        other_user = User.signup(
+            username="otheruser",
+            email="other@test.com",
+            password="otheruser",
+            image_url=None
+        )
+        db.session.flush()
+
+        msg = Message(text="Liked", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.flush()
+
+        db.session.add(Like(user_id=other_user.id, message_id=msg.id))
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post(f"/messages/{msg_id}/delete")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, f"/users/{self.testuser.id}")
+            self.assertIsNone(db.session.get(Message, msg_id))
+            self.assertEqual(Like.query.count(), 0)
+
+class TimelineCacheViewTestCase(TestCase):
+    """Test that writes clear cached timelines.
+
+    TestingConfig turns caching off, so these tests swap in a real
+    (in-process) cache backend.
+    """
+
+    def setUp(self):
+        """Create test client, add sample data, turn the cache on."""
+
+        clear_tables()
+        self.app.config["CACHE_TYPE"] = "SimpleCache"
+        cache.init_app(self.app)
+
+        self.client = self.app.test_client()
+
+        testuser = User.signup(
+            username="testuser",
+            email="test@test.com",
+            password="testuser",
+            image_url=None
+        )
+        other_user = User.signup(
+            username="otheruser",
+            email="other@test.com",
+            password="otheruser",
+            image_url=None
+        )
+        db.session.commit()
+
+        self.testuser_id = testuser.id
+        self.other_user_id = other_user.id
+
+    def tearDown(self):
+        """Go back to TestingConfig's cache and clean up."""
+
+        self.app.config["CACHE_TYPE"] = "NullCache"
+        cache.init_app(self.app)
+        db.session.rollback()
+
+    def get_homepage(self, client, user_id):
+        """Fetch / as `user_id`."""
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        return client.get("/").data
+
+    def test_timeline_is_cached(self):
+        """Is a timeline served from the cache until something clears it?"""
+
+        with self.client as c:
+            self.get_homepage(c, self.testuser_id)
+
+            # written behind the app's back, so nothing clears the cache
+            db.session.add(Message(text="Sneaky", user_id=self.testuser_id))
+            db.session.commit()
+
+            self.assertNotIn(b"Sneaky", self.get_homepage(c, self.testuser_id))
+
+    def test_new_message_clears_timelines(self):
+        """Does posting show up on the poster's and followers' homepages?"""
+
+        db.session.add(Follows(
+            user_following_id=self.testuser_id,
+            user_being_followed_id=self.other_user_id,
+        ))
+        db.session.commit()
+
+        with self.client as c:
+            self.get_homepage(c, self.testuser_id)
+            self.get_homepage(c, self.other_user_id)
+
+            c.post("/messages/new", data={"text": "Fresh warble"})
+
+            self.assertIn(
+                b"Fresh warble", self.get_homepage(c, self.other_user_id)
+            )
+            self.assertIn(
+                b"Fresh warble", self.get_homepage(c, self.testuser_id)
+            )
+
+    def test_follow_and_unfollow_clear_timeline(self):
+        """Do following/unfollowing change the follower's homepage?"""
+
+        db.session.add(Message(text="Followed", user_id=self.other_user_id))
+        db.session.commit()
+
+        with self.client as c:
+            self.assertNotIn(
+                b"Followed", self.get_homepage(c, self.testuser_id)
+            )
+
+            c.post(
+                f"/users/follow/{self.other_user_id}",
+                headers={"Referer": "/"}
+            )
+            self.assertIn(b"Followed", self.get_homepage(c, self.testuser_id))
+
+            c.post(f"/users/stop-following/{self.other_user_id}")
+            self.assertNotIn(
+                b"Followed", self.get_homepage(c, self.testuser_id)
+            )
@@ -1,40 +1,34 @@
-import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+import pytest
+from sqlalchemy import text
+from sqlalchemy.orm import selectinload
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+from conftest import clear_tables
+from models import db, upgrade_db, User, Message, Follows
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-# Now we can import app
-
-from app import app
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
+# Tables are created once for the whole run in conftest.py --- in each
+# test, we'll delete the data and create fresh new clean test data
 
 
+@pytest.mark.usefixtures("no_lazy_loads")
 class UserModelTestCase(TestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        Follows.query.delete()
-        User.query.delete()
-        Message.query.delete()
+        clear_tables()
 
         # TODO add some sample data into here
         # and utilize 'self' to call in below tests
 
-        self.client = app.test_client()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
 
     def test_user_model(self):
         """Does basic model work?"""
@@ -94,6 +88,15 @@ class UserModelTestCase(TestCase):
         db.session.add(test_follow)
         db.session.commit()
 
+        # reload the users like a view would, explicitly loading the
+        # collections is_following/is_followed_by walk
+        db.session.expunge_all()
+        u1, u2 = db.session.scalars(
+            db.select(User)
+            .options(selectinload(User.following), selectinload(User.followers))
+            .order_by(User.id)
+        ).all()
+
         test_is_following = u1.is_following(u2)
         test_followed_by = u2.is_followed_by(u1)
 
@@ -212,3 +215,96 @@ class UserModelTestCase(TestCase):
 
         user = User.authenticate("authed_user", "something_else")
         self.assertEqual(user, False)
+
+    def test_follow_counts(self):
+        """Are the follower/following counts kept in step with follows?"""
+
+        u1 = User(
+            email="counttestuser1@test.com",
+            username="counttestuser1",
+            password="HASHED_PASSWORD"
+        )
+
+        u2 = User(
+            email="counttestuser2@test.com",
+            username="counttestuser2",
+            password="HASHED_PASSWORD"
+        )
+
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        test_follow = Follows(
+            user_being_followed_id=u2.id,
+            user_following_id=u1.id
+        )
+        db.session.add(test_follow)
+        db.session.commit()
+
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u1.followers_count, 0)
+        self.assertEqual(u2.followers_count, 1)
+        self.assertEqual(u2.following_count, 0)
+
+        db.session.delete(test_follow)
+        db.session.commit()
+
+        self.assertEqual(u1.following_count, 0)
+        self.assertEqual(u2.followers_count, 0)
+
+    def test_upgrade_db_adds_and_backfills_counts(self):
+        """Does upgrade_db bring a db from before the count columns up to
+        date, keeping its data, and is it safe to run again?"""
+
+        u1 = User(
+            email="upgradetestuser1@test.com",
+            username="upgradetestuser1",
+            password="HASHED_PASSWORD"
+        )
+
+        u2 = User(
+            email="upgradetestuser2@test.com",
+            username="upgradetestuser2",
+            password="HASHED_PASSWORD"
+        )
+
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1_id, u2_id = u1.id, u2.id
+
+        db.session.add_all([
+            Follows(user_being_followed_id=u2_id, user_following_id=u1_id),
+            Message(text="old warble", user_id=u2_id),
+        ])
+        db.session.commit()
+
+        # put the schema back the way older versions created it
+        db.session.expunge_all()
+        db.session.execute(text("""
+            DROP TRIGGER follows_update_counts ON follows;
+            DROP TRIGGER messages_update_count ON messages;
+            DROP INDEX ix_messages_user_id_timestamp;
+            ALTER TABLE users
+                DROP COLUMN messages_count,
+                DROP COLUMN followers_count,
+                DROP COLUMN following_count;
+        """))
+        db.session.commit()
+
+        upgrade_db()
+        upgrade_db()
+
+        u1, u2 = db.session.scalars(
+            db.select(User).order_by(User.id)
+        ).all()
+
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u2.followers_count, 1)
+        self.assertEqual(u2.messages_count, 1)
+        self.assertEqual(u1.messages_count, 0)
+
+        # and the triggers are back
+        db.session.add(Message(text="new warble", user_id=u1_id))
+        db.session.commit()
+
+        self.assertEqual(u1.messages_count, 1)
@@ -1,55 +1,93 @@
 """User view tests."""
 
-import os
 from unittest import TestCase
 from flask import session
+from sqlalchemy.orm import scoped_session, sessionmaker
 
-from models import db, User, Message, Follows, Like
+from conftest import clear_tables
+from models import db, bcrypt, DEFAULT_IMAGE_URL, User, Follows
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-from app import app
+PRE_HASHED = bcrypt.generate_password_hash("test_userpass").decode('UTF-8')
 
-app.config['WTF_CSRF_ENABLED'] = False
 
+class TransactionalViewTestCase(TestCase):
+    """Run each test in a transaction that's rolled back afterwards.
 
-# db.drop_all()
-db.create_all()
+    Sample data is added once per class in setUpClass. Commits made by a
+    test (or the views it calls) only release a SAVEPOINT inside that
+    transaction, so every test starts from the same sample data.
+    """
 
+    def setUp(self):
+        """Bind the db session to a connection in an outer transaction.
+
+        The class shares one test client; its session cookie is dropped so
+        every test starts logged out.
+        """
+
+        self.client.delete_cookie(self.app.config["SESSION_COOKIE_NAME"])
 
-class UserAuthViewTestCase(TestCase):
+        # end the transaction the class setup left open on the shared
+        # connection (see conftest.py), then start the outer one
+        db.session.close()
+        self.connection = db.session.bind
+        self.transaction = self.connection.begin()
+
+        self.app_session = db.session
+        db.session = scoped_session(sessionmaker(
+            bind=self.connection,
+            join_transaction_mode="create_savepoint",
+        ))
+
+    def tearDown(self):
+        """Throw away everything the test did."""
+
+        db.session.remove()
+        db.session = self.app_session
+
+        self.transaction.rollback()
+
+
+class UserAuthViewTestCase(TransactionalViewTestCase):
     """Test user authentication routes."""
 
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
         """Add sample data """
 
-        # Need to empty out join table first to respect foreign key constraints
-        Like.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
-        User.query.delete()
-
-        self.client = app.test_client()
+        clear_tables()
 
         test_user = User.signup(
             username="test_user",
             email="test@test.com",
             password="test_userpass",
-            image_url=None
+            image_url=DEFAULT_IMAGE_URL
         )
 
         db.session.commit()
-        self.test_user_id = test_user.id
-
-    def tearDown(self):
-        """Clean up any fouled transaction."""
-
-        db.session.rollback()
+        cls.test_user_id = test_user.id
+
+        cls.client = cls.app.test_client()
+
+        # log in once and keep the signed session cookie, so tests that
+        # just need a logged-in user can skip the POST and bcrypt check
+        login_client = cls.app.test_client()
+        login_client.post(
+            "/login",
+            data={
+                'username': 'test_user',
+                'password': 'test_userpass'
+            }
+        )
+        cls.session_cookie = login_client.get_cookie(
+            cls.app.config["SESSION_COOKIE_NAME"]
+        ).value
 
     def test_login_valid_creds_redirect(self):
         """Can a user login with valid credentials and see
         the correct homepage?"""
 
-        with app.test_client() as client:
+        with self.client as client:
             resp = client.post(
                 "/login",
                 data={
@@ -59,30 +97,28 @@ class UserAuthViewTestCase(TestCase):
             )
             self.assertEqual(resp.status_code, 302)
             self.assertEqual(resp.location, "/")
+            self.assertEqual(session['curr_user'], self.test_user_id)
 
-    def test_login_valid_creds_redirect_followed(self):
-        """Can a user login with valid credentials and see
-        the correct homepage?"""
+    def test_homepage_for_logged_in_user(self):
+        """Does a logged-in user see their own homepage?"""
 
-        with app.test_client() as client:
-            resp = client.post(
-                "/login",
-                data={
-                    'username': 'test_user',
-                    'password': 'test_userpass'
-                },
-                follow_redirects=True
+        with self.client as client:
+            client.set_cookie(
+                self.app.config["SESSION_COOKIE_NAME"],
+                self.session_cookie
             )
-            html = resp.get_data(as_text=True)
+
+            resp = client.get("/")
+            html = resp.data
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("@test_user", html)
+            self.assertIn(b"@test_user", html)
 
     def test_login_invalid_creds_redirect(self):
         """Can a user login with invalid credentials and see
         the correct page?"""
 
-        with app.test_client() as client:
+        with self.client as client:
             resp = client.post(
                 "/login",
                 data={
@@ -90,46 +126,71 @@ class UserAuthViewTestCase(TestCase):
                     'password': 'test_userpass1'
                 }
             )
-            html = resp.get_data(as_text=True)
+            html = resp.data
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("Invalid credentials", html)
-            self.assertNotIn("Log out", html)
+            self.assertIn(b"Invalid credentials", html)
+            self.assertNotIn(b"Log out", html)
+
+    def test_login_rate_limited(self):
+        """Are repeated login attempts from one address cut off?"""
+
+        with self.client as client:
+            for _ in range(5):
+                resp = client.post(
+                    "/login",
+                    data={
+                        'username': 'test_user',
+                        'password': 'wrongpass'
+                    }
+                )
+                self.assertEqual(resp.status_code, 200)
+
+            resp = client.post(
+                "/login",
+                data={
+                    'username': 'test_user',
+                    'password': 'test_userpass'
+                }
+            )
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertNotIn('curr_user', session)
 
     def test_signup_form_displays(self):
         """Can a user get to the signup form?"""
 
-        with app.test_client() as client:
+        with self.client as client:
             resp = client.get("/signup")
-            html = resp.get_data(as_text=True)
+            html = resp.data
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("Join Warbler today.", html)
+            self.assertIn(b"Join Warbler today.", html)
 
-    def test_signup_valid_creds_redirect_followed(self):
-        """Can a user sign up with valid credentials and see
-        the correct homepage?"""
+    def test_signup_valid_creds_redirect(self):
+        """Can a user sign up with valid credentials and get
+        logged in and sent to the homepage?"""
 
-        with app.test_client() as client:
+        with self.client as client:
             resp = client.post(
                 "/signup",
                 data={
                     'username': 'newuser',
                     'password': 'newuserpass',
                     'email': 'new@new.com'
-                },
-                follow_redirects=True
+                }
             )
-            html = resp.get_data(as_text=True)
+            new_user = User.query.filter_by(username='newuser').one()
 
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn("@newuser", html)
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, "/")
+            self.assertEqual(session['curr_user'], new_user.id)
 
     def test_signup_invalid_creds_redirect_followed(self):
         """Can a user sign up with invalid credentials and get
         redirected back to the signup form?"""
 
-        with app.test_client() as client:
+        with self.client as client:
             resp = client.post(
                 "/signup",
                 data={
@@ -139,43 +200,46 @@ class UserAuthViewTestCase(TestCase):
                 },
                 follow_redirects=True
             )
-            html = resp.get_data(as_text=True)
+            html = resp.data
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("Join Warbler today.", html)
-            self.assertIn("Username already taken", html)
-            self.assertNotIn("@newuser", html)
+            self.assertIn(b"Join Warbler today.", html)
+            self.assertIn(b"Username already taken", html)
+            self.assertNotIn(b"@newuser", html)
 
     def test_logout_works_for_auth_user(self):
         """Can a logged-in user successfully log out?"""
 
-        with app.test_client() as client:
+        with self.client as client:
             with client.session_transaction() as change_session:
                 change_session['curr_user'] = self.test_user_id
 
             resp = client.post("/logout", follow_redirects=True)
-            html = resp.get_data(as_text=True)
+            html = resp.data
 
             self.assertEqual(resp.status_code, 200)
             self.assertTrue('curr_user' not in session)
-            self.assertIn('Welcome back.', html)
+            self.assertIn(b'Welcome back.', html)
 
     def test_logout_redirects_for_anon_user(self):
         """Is an anon user blocked from logging out?"""
 
-        with app.test_client() as client:
+        with self.client as client:
+            resp = client.post("/logout")
 
-            resp = client.post("/logout", follow_redirects=True)
-            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, "/")
 
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn('Access unauthorized.', html)
+            with client.session_transaction() as change_session:
+                flashes = change_session.get('_flashes', [])
+
+            self.assertIn(("danger", "Access unauthorized."), flashes)
 
     def test_see_followers(self):
         """When logged in, can a user see the follower page
         for any user?"""
 
-        with app.test_client() as client:
+        with self.client as client:
 
             u2 = User(
                 email="viewfollowerstest_user@test.com",
@@ -187,85 +251,275 @@ class UserAuthViewTestCase(TestCase):
             db.session.commit()  # this marks the end of the transaction
             u2_id = u2.id
 
-            client.post(
-                "/login",
-                data={
-                    'username': 'test_user',
-                    'password': 'test_userpass'
-                },
-                follow_redirects=True
-            )
+            with client.session_transaction() as change_session:
+                change_session['curr_user'] = self.test_user_id
 
             followers_resp = client.get(f"/users/{u2_id}/followers")
-            html = followers_resp.get_data(as_text=True)
+            html = followers_resp.data
 
             self.assertEqual(followers_resp.status_code, 200)
-            self.assertIn("test page for followers", html)
+            self.assertIn(b"test page for followers", html)
 
 
-class UserViewTestCase(TestCase):
+class UserViewTestCase(TransactionalViewTestCase):
     """Test general user routes."""
 
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
         """Add sample data """
 
-        # Need to empty out join table first to respect foreign key constraints
-        Like.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
-        User.query.delete()
+        clear_tables()
 
-        self.client = app.test_client()
-
-        test_user_1 = User.signup(
-            username="test_user1",
-            email="test1@test.com",
-            password="test_user_1pass",
-            image_url=None
-        )
-
-        test_user_2 = User.signup(
-            username="test_user2",
-            email="test2@test.com",
-            password="test_user_2pass",
-            image_url=None
-        )
+        # one INSERT for both users, sharing a password hashed at import
+        cls.test_user_1_id, cls.test_user_2_id = db.session.scalars(
+            db.insert(User).returning(User.id, sort_by_parameter_order=True),
+            [
+                {
+                    "username": "test_user1",
+                    "email": "test1@test.com",
+                    "password": PRE_HASHED,
+                },
+                {
+                    "username": "test_user2",
+                    "email": "test2@test.com",
+                    "password": PRE_HASHED,
+                },
+            ],
+        ).all()
 
         db.session.commit()
-        self.test_user_1_id = test_user_1.id
-        self.test_user_2_id = test_user_2.id
-
-    def tearDown(self):
-        """Clean up any fouled transaction."""
 
-        db.session.rollback()
+        cls.client = cls.app.test_client()
 
     def test_list_all_users(self):
         """Can a logged-in user see all users?"""
 
-        with app.test_client() as client:
+        with self.client as client:
             with client.session_transaction() as change_session:
                 change_session['curr_user'] = self.test_user_1_id
 
             resp = client.get("/users", follow_redirects=True)
-            html = resp.get_data(as_text=True)
+            html = resp.data
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("test_user2", html)
+            self.assertIn(b"test_user2", html)
 
     def test_search_users(self):
         """Can a logged-in user search users?"""
 
-        with app.test_client() as client:
+        with self.client as client:
             with client.session_transaction() as change_session:
                 change_session['curr_user'] = self.test_user_1_id
 
-            resp = client.get(
-                "/users",
-                query_string={"q": "2"},
-                follow_redirects=True
-            )
-            html = resp.get_data(as_text=True)
+            resp = client.get("/users?q=2", follow_redirects=True)
+            html = resp.data
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"test_user2", html)
+
+    def test_search_users_ignores_case(self):
+        """Does searching match usernames regardless of case?"""
+
+        with self.client as client:
+            with client.session_transaction() as change_session:
+                change_session['curr_user'] = self.test_user_1_id
+
+            resp = client.get("/users?q=TEST_USER2")
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("test_user2", html)
+            self.assertIn(b"test_user2", resp.data)
+            self.assertNotIn(b"Sorry, no users found", resp.data)
+
+    def add_page_users(self, count):
+        """Add `count` users named page_user_00, page_user_01, ..., which
+        sort before the test_user* users."""
+
+        db.session.execute(db.insert(User), [
+            {
+                "username": f"page_user_{i:02}",
+                "email": f"page{i}@test.com",
+                "password": PRE_HASHED,
+            }
+            for i in range(count)
+        ])
+        db.session.commit()
+
+    def test_list_users_pages(self):
+        """Are users listed 50 to a page, with links to the other pages?"""
+
+        self.add_page_users(60)
+
+        with self.client as client:
+            with client.session_transaction() as change_session:
+                change_session['curr_user'] = self.test_user_1_id
+
+            resp = client.get("/users")
+            html = resp.data
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"page_user_00", html)
+            self.assertNotIn(b"test_user2", html)
+            self.assertIn(b'href="/users?page=2"', html)
+
+            resp = client.get("/users?page=2")
+            html = resp.data
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"test_user2", html)
+            self.assertNotIn(b"page_user_00", html)
+
+    def test_list_users_page_links_keep_search(self):
+        """Do the page links of a search stay within the search?"""
+
+        self.add_page_users(60)
+
+        with self.client as client:
+            with client.session_transaction() as change_session:
+                change_session['curr_user'] = self.test_user_1_id
+
+            resp = client.get("/users?q=page_user")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b'href="/users?page=2&amp;q=page_user"', resp.data)
+
+    def test_list_users_page_out_of_range(self):
+        """Is a page past the last one a 404?"""
+
+        with self.client as client:
+            with client.session_transaction() as change_session:
+                change_session['curr_user'] = self.test_user_1_id
+
+            resp = client.get("/users?page=5")
+
+            self.assertEqual(resp.status_code, 404)
+
+    def test_list_users_redirects_for_anon_user(self):
+        """Is an anon user blocked from seeing all users?"""
+
+        with self.client as client:
+            resp = client.get("/users")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, "/")
+
+            with client.session_transaction() as change_session:
+                flashes = change_session.get('_flashes', [])
+
+            self.assertIn(("danger", "Access unauthorized."), flashes)
+
+    def test_deleted_user_session_is_logged_out(self):
+        """Is a session for a user that no longer exists treated like an
+        anon user, rather than running the view without a user?"""
+
+        for method, url in [
+            ("post", "/messages/new"),
+            ("post", "/users/delete"),
+            ("get", "/users/profile"),
+        ]:
+            with self.subTest(url=url), self.client as client:
+                with client.session_transaction() as change_session:
+                    change_session['curr_user'] = self.test_user_2_id + 1000
+
+                resp = getattr(client, method)(url)
+
+                self.assertEqual(resp.status_code, 302)
+                self.assertEqual(resp.location, "/")
+
+                with client.session_transaction() as change_session:
+                    flashes = change_session.get('_flashes', [])
+                    self.assertNotIn('curr_user', change_session)
+
+                self.assertIn(("danger", "Access unauthorized."), flashes)
+
+    def test_follow_and_unfollow_user(self):
+        """Can a logged-in user follow and then unfollow another user?"""
+
+        with self.client as client:
+            with client.session_transaction() as change_session:
+                change_session['curr_user'] = self.test_user_1_id
+
+            resp = client.post(
+                f"/users/follow/{self.test_user_2_id}",
+                headers={"Referer": "/users"}
+            )
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, "/users")
+            self.assertEqual(Follows.query.count(), 1)
+
+            resp = client.post(
+                f"/users/stop-following/{self.test_user_2_id}",
+                headers={"Referer": "/users"}
+            )
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Follows.query.count(), 0)
+
+    def test_follow_user_twice(self):
+        """Does following someone already followed leave the follow alone?"""
+
+        with self.client as client:
+            with client.session_transaction() as change_session:
+                change_session['curr_user'] = self.test_user_1_id
+
+            for _ in range(2):
+                resp = client.post(
+                    f"/users/follow/{self.test_user_2_id}",
+                    headers={"Referer": "/users"}
+                )
+
+                self.assertEqual(resp.status_code, 302)
+                self.assertEqual(resp.location, "/users")
+
+            self.assertEqual(Follows.query.count(), 1)
+
+    def test_edit_profile(self):
+        """Can a user edit their profile with their current password?"""
+
+        with self.client as client:
+            with client.session_transaction() as change_session:
+                change_session['curr_user'] = self.test_user_1_id
+
+            resp = client.post(
+                "/users/profile",
+                data={
+                    'username': 'renamed_user1',
+                    'email': 'test1@test.com',
+                    'password': 'test_userpass'
+                }
+            )
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, f"/users/{self.test_user_1_id}")
+            self.assertEqual(
+                db.session.get(User, self.test_user_1_id).username,
+                'renamed_user1'
+            )
+
+    def test_edit_profile_wrong_password(self):
+        """Is a profile edit with the wrong password turned away?"""
+
+        with self.client as client:
+            with client.session_transaction() as change_session:
+                change_session['curr_user'] = self.test_user_1_id
+
+            resp = client.post(
+                "/users/profile",
+                data={
+                    'username': 'renamed_user1',
+                    'email': 'test1@test.com',
+                    'password': 'wrongpass'
+                }
+            )
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, "/")
+            self.assertEqual(
+                db.session.get(User, self.test_user_1_id).username,
+                'test_user1'
+            )
+
+            with client.session_transaction() as change_session:
+                flashes = change_session.get('_flashes', [])
+
+            self.assertIn(("danger", "Unauthorized."), flashes)
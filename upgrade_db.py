@@ -0,0 +1,16 @@
+"""Update an existing Warbler database to match the current models.
+
+Unlike seed.py, this keeps all the existing data.
+"""
+
+import logging
+
+from app import app
+from models import upgrade_db
+
+# show warnings postgres raises along the way (e.g. pg_trgm being missing)
+logging.basicConfig()
+logging.getLogger("sqlalchemy.dialects.postgresql").setLevel(logging.INFO)
+
+with app.app_context():
+    upgrade_db()
@@ -0,0 +1,37 @@
+"""WSGI entrypoint for running Warbler under gunicorn's gevent workers.
+
+Run with (settings are picked up from gunicorn.conf.py):
+
+    gunicorn wsgi:app
+"""
+
+# Patching has to happen before anything else imports socket/threading or
+# psycopg2, so these stay above the app import.
+from gevent import monkey
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+from gevent import get_hub
+
+from app import app
+from models import bcrypt
+
+# gunicorn loads `app` from here
+__all__ = ["app"]
+
+
+def _in_threadpool(func):
+    """Run `func` on the gevent hub's threadpool instead of the event loop."""
+
+    def wrapper(*args, **kwargs):
+        return get_hub().threadpool.apply(func, args, kwargs)
+
+    return wrapper
+
+
+# bcrypt hashes in C and never yields to gevent; run it in a real thread so
+# a login or signup doesn't stall every other request in the worker
+bcrypt.generate_password_hash = _in_threadpool(bcrypt.generate_password_hash)
+bcrypt.check_password_hash = _in_threadpool(bcrypt.check_password_hash)